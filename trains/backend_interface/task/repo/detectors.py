@@ -1,10 +1,11 @@
 import abc
 import os
-from subprocess import call, CalledProcessError
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import CalledProcessError
 
 import attr
 import six
-from pathlib2 import Path
 
 from ....config.defs import (
     VCS_REPO_TYPE,
@@ -14,13 +15,64 @@ from ....config.defs import (
     VCS_BRANCH,
     VCS_COMMIT_ID,
     VCS_REPOSITORY_URL,
+    VCS_DETECT_CONCURRENT,
 )
 from ....debugging import get_logger
-from .util import get_command_output
+from .util import get_command_output, get_command_status
 
 _logger = get_logger("Repository Detection")
 
 
+class _LRUCache(object):
+    """ Bounded mapping dropping the least recently used entries (unlike lru_cache, callers choose what to keep) """
+
+    def __init__(self, max_size=128):
+        self._max_size = max_size
+        self._data = OrderedDict()
+
+    def get(self, key):
+        value = self._data.pop(key, None)
+        if value is not None:
+            self._data[key] = value
+        return value
+
+    def set(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self._max_size:
+            try:
+                self._data.popitem(last=False)
+            except KeyError:
+                break
+
+
+# found repository metadata entries, by (path, type name). Only positive results are kept, so that a
+# repository created after a path was first probed is still detected
+_repo_entries = _LRUCache()
+
+
+def _find_repo_entry(path, type_name):
+    """
+    Find the repository metadata entry (e.g. ".git") in path or any of its parents, without running the VCS
+    :return: Path of the metadata entry (a folder, or a file pointing to one), or None if not found
+    """
+    key = (path, type_name)
+    entry = _repo_entries.get(key)
+    # a single stat verifies the cached entry was not removed since
+    if entry and os.path.exists(entry):
+        return entry
+    current = os.path.abspath(path)
+    while True:
+        entry = os.path.join(current, "." + type_name)
+        if os.path.exists(entry):
+            _repo_entries.set(key, entry)
+            return entry
+        parent = os.path.dirname(current)
+        if parent == current:
+            return None
+        current = parent
+
+
 class DetectionError(Exception):
     pass
 
@@ -51,6 +103,18 @@ class Detector(object):
     """
 
     _fallback = '_fallback'
+    _check = '_check'
+    _batched = False
+    _metadata_files = ()
+    """ Files inside the repository metadata folder whose modification time invalidates cached info """
+
+    _cached_fields = ("url", "branch", "commit", "root")
+    """ Info attributes that only change with the repository metadata (working tree state is always queried) """
+
+    _path_option = None
+    """ VCS option for running in a given folder, so commands are launched without changing the working directory """
+
+    _info_cache = _LRUCache()
 
     @attr.s
     class Commands(object):
@@ -65,26 +129,62 @@ class Detector(object):
         modified = attr.ib(default=None, type=list)
         # alternative commands
         branch_fallback = attr.ib(default=None, type=list)
+        # cheap commands exiting with a zero status only when the matching command's output would be empty
+        diff_check = attr.ib(default=None, type=list)
 
     def __init__(self, type_name, name=None):
         self.type_name = type_name
         self.name = name or type_name
+        # commands are fixed per detector, build them once
+        self._commands = attr.asdict(self._get_commands())
 
     def _get_commands(self):
         """ Returns a RepoInfo instance containing a command for each info attribute """
         return self.Commands()
 
+    def _get_path_command(self, command, path):
+        """ Returns a (command, cwd) tuple for running command in path """
+        if self._path_option and path:
+            return [command[0], self._path_option, str(path)] + list(command[1:]), None
+        return command, path
+
+    def _run_command(self, command, path):
+        """ Run a command in path and return its output """
+        return get_command_output(*self._get_path_command(command, path))
+
+    def _batched_commands(self):
+        """
+        Returns a list of (names, command) tuples, where each command outputs the values of all named info
+        attributes, one per line and in the same order (used only when _batched is set)
+        """
+        return []
+
+    def _get_batched_output(self, path):
+        """
+        Run all batched commands and map their output lines onto info attribute names
+        :raises CalledProcessError: when command execution fails
+        :raises UnicodeDecodeError: when output decoding fails
+        :raises ValueError: when the output does not match the expected attributes
+        """
+        values = {}
+        for names, command in self._batched_commands():
+            lines = self._run_command(command, path).splitlines()
+            if len(lines) != len(names):
+                raise ValueError("Unexpected {} output: {}".format(self.type_name, lines))
+            values.update(zip(names, (line.strip() for line in lines)))
+        return values
+
     def _get_command_output(self, path, name, command):
         """ Run a command and return its output """
         try:
-            return get_command_output(command, path)
+            return self._run_command(command, path)
 
         except (CalledProcessError, UnicodeDecodeError) as ex:
             if not name.endswith(self._fallback):
-                fallback_command = attr.asdict(self._get_commands()).get(name + self._fallback)
+                fallback_command = self._commands.get(name + self._fallback)
                 if fallback_command:
                     try:
-                        return get_command_output(fallback_command, path)
+                        return self._run_command(fallback_command, path)
                     except (CalledProcessError, UnicodeDecodeError):
                         pass
             _logger.warning("Can't get {} information for {} repo in {}".format(name, self.type_name, path))
@@ -96,25 +196,60 @@ class Detector(object):
             )
             return ""
 
-    def _get_info(self, path, include_diff=False):
+    def _get_checked_command_output(self, path, name, command):
+        """ Run a command and return its output, unless its check command exit status indicates it is empty """
+        check_command = self._commands.get(name + self._check)
+        if check_command:
+            try:
+                if get_command_status(*self._get_path_command(check_command, path)) == 0:
+                    return ""
+            except (OSError, EnvironmentError, IOError):
+                # check can't be executed, run the full command
+                pass
+        return self._get_command_output(path, name, command)
+
+    def _get_info(self, path, include_diff=False, known=None):
         """
         Get repository information.
         :param path: Path to repository
         :param include_diff: Whether to include the diff command's output (if available)
+        :param known: Dictionary of already known info attributes (their commands are not run)
         :return: RepoInfo instance
         """
         path = str(path)
-        commands = self._get_commands()
-        if not include_diff:
-            commands.diff = None
-
-        info = Result(
-            **{
-                name: self._get_command_output(path, name, command)
-                for name, command in attr.asdict(commands).items()
-                if command and not name.endswith(self._fallback)
-            }
-        )
+
+        values = dict(known or {})
+        batched_names = [name for names, _ in self._batched_commands() for name in names]
+        if self._batched and any(name not in values for name in batched_names):
+            try:
+                batched = self._get_batched_output(path)
+                batched.update(values)
+                values = batched
+            except (CalledProcessError, UnicodeDecodeError, ValueError) as ex:
+                # fall back to running a separate command per attribute
+                _logger.debug("Batched {} query failed in {}: {}".format(self.type_name, path, str(ex)))
+
+        pending = [
+            (name, command)
+            for name, command in self._commands.items()
+            if command and not name.endswith((self._fallback, self._check)) and name not in values
+            and (include_diff or name != "diff")
+        ]
+
+        if len(pending) > 1 and VCS_DETECT_CONCURRENT.get():
+            # commands are independent and mostly wait on the subprocess, run them all at once
+            with ThreadPoolExecutor(max_workers=len(pending)) as pool:
+                futures = {
+                    name: pool.submit(self._get_checked_command_output, path, name, command)
+                    for name, command in pending
+                }
+                values.update({name: future.result() for name, future in futures.items()})
+        else:
+            values.update(
+                {name: self._get_checked_command_output(path, name, command) for name, command in pending}
+            )
+
+        info = Result(**values)
 
         return info
 
@@ -122,6 +257,33 @@ class Detector(object):
         # check if there are uncommitted changes in the current repository
         return info
 
+    def _get_metadata_files(self, repo_dir):
+        """ Returns the metadata files (relative to repo_dir) whose modification time invalidates cached info """
+        return self._metadata_files
+
+    def _get_metadata_stamp(self, path):
+        """
+        Get the state (modification time, inode and size) of the repository metadata files for the repository
+        containing path
+        :return: Tuple of (file, state) pairs (state is None for missing files), or None if the repository
+            metadata folder could not be found
+        """
+        if not self._metadata_files:
+            return None
+        repo_dir = _find_repo_entry(str(path), self.type_name)
+        if not repo_dir or not os.path.isdir(repo_dir):
+            return None
+        stamp = []
+        for f in self._get_metadata_files(repo_dir):
+            try:
+                st = os.stat(os.path.join(repo_dir, f))
+            except (OSError, IOError):
+                stamp.append((f, None))
+                continue
+            # refs are replaced by rename, inode and size catch updates within a coarse mtime resolution
+            stamp.append((f, (getattr(st, "st_mtime_ns", st.st_mtime), st.st_ino, st.st_size)))
+        return tuple(stamp)
+
     def get_info(self, path, include_diff=False):
         """
         Get repository information.
@@ -129,21 +291,27 @@ class Detector(object):
         :param include_diff: Whether to include the diff command's output (if available)
         :return: RepoInfo instance
         """
-        info = self._get_info(path, include_diff)
+        key = (self.type_name, os.path.abspath(str(path)))
+        # stamp is taken before running any command, so changes made meanwhile invalidate the stored entry
+        stamp = self._get_metadata_stamp(str(path))
+        cached = self._info_cache.get(key)
+        known = cached[1] if stamp is not None and cached and cached[0] == stamp else None
+
+        info = self._get_info(path, include_diff, known=known)
+        if stamp is not None and known is None:
+            # cache the raw values, post-processing is applied on every call
+            self._info_cache.set(key, (stamp, {name: getattr(info, name) for name in self._cached_fields}))
         return self._post_process_info(info)
 
     def _is_repo_type(self, script_path):
+        entry = _find_repo_entry(str(script_path), self.type_name)
+        if not entry:
+            return False
+        if os.path.isdir(entry):
+            return True
+        # metadata entry is not a folder (e.g. a git worktree or submodule), let the VCS decide
         try:
-            with open(os.devnull, "wb") as devnull:
-                return (
-                    call(
-                        [self.type_name, "status"],
-                        stderr=devnull,
-                        stdout=devnull,
-                        cwd=str(script_path),
-                    )
-                    == 0
-                )
+            return get_command_status(*self._get_path_command([self.type_name, "status"], str(script_path))) == 0
         except CalledProcessError:
             _logger.warning("Can't get {} status".format(self.type_name))
         except (OSError, EnvironmentError, IOError):
@@ -160,6 +328,9 @@ class Detector(object):
 
 
 class HgDetector(Detector):
+    _metadata_files = ("dirstate", "branch", "hgrc")
+    _path_option = "--cwd"
+
     def __init__(self):
         super(HgDetector, self).__init__("hg")
 
@@ -172,6 +343,7 @@ class HgDetector(Detector):
             status=["hg", "status"],
             diff=["hg", "diff"],
             modified=["hg", "status", "-m"],
+            # no diff_check, hg has no command reporting uncommitted changes through its exit status
         )
 
     def _post_process_info(self, info):
@@ -185,9 +357,32 @@ class HgDetector(Detector):
 
 
 class GitDetector(Detector):
+    _batched = True
+    _metadata_files = ("HEAD", "packed-refs", "config")
+    _path_option = "-C"
+
     def __init__(self):
         super(GitDetector, self).__init__("git")
 
+    def _get_metadata_files(self, repo_dir):
+        files = list(self._metadata_files)
+        # HEAD usually only points to a branch ref, which changes when the branch moves (commit, reset, pull)
+        try:
+            with open(os.path.join(repo_dir, "HEAD")) as f:
+                head = f.read().strip()
+        except (OSError, IOError):
+            return files
+        if head.startswith("ref:"):
+            files.append(os.path.normpath(head[len("ref:"):].strip()))
+        return files
+
+    def _batched_commands(self):
+        # a single rev-parse resolves both root and commit (branch is left out, as its upstream lookup fails on
+        # detached heads and local-only branches, and needs the fallback command)
+        return [
+            (("root", "commit"), ["git", "rev-parse", "--show-toplevel", "HEAD"]),
+        ]
+
     def _get_commands(self):
         return self.Commands(
             url=["git", "remote", "get-url", "origin"],
@@ -198,6 +393,7 @@ class GitDetector(Detector):
             diff=["git", "diff"],
             modified=["git", "ls-files", "-m"],
             branch_fallback=["git", "rev-parse", "--abbrev-ref", "HEAD"],
+            diff_check=["git", "diff", "--quiet"],
         )
 
     def _post_process_info(self, info):
@@ -224,19 +420,19 @@ class EnvDetector(Detector):
         """
         Get the absolute location of the parent folder (where .git resides)
         """
-        root_parts = list(reversed(Path(root).parts))
-        cwd_abs = list(reversed(Path.cwd().parts))
-        count = len(cwd_abs)
-        for i, p in enumerate(cwd_abs):
-            if i >= len(root_parts):
-                break
-            if p == root_parts[i]:
-                count -= 1
-        cwd_abs.reverse()
-        root_abs_path = Path().joinpath(*cwd_abs[:count])
-        return str(root_abs_path)
-
-    def _get_info(self, _, include_diff=False):
+        cwd = os.getcwd()
+        cwd_parts = cwd.split(os.sep)
+        root_parts = os.path.normpath(root).split(os.sep)
+        # strip one trailing cwd folder for each trailing root folder it matches
+        matching = sum(1 for c, r in zip(reversed(cwd_parts), reversed(root_parts)) if c == r)
+        if matching >= len(cwd_parts):
+            # every cwd part matched, including the filesystem root / drive (root is the absolute cwd)
+            return os.curdir
+        for _ in range(matching):
+            cwd = os.path.dirname(cwd)
+        return cwd
+
+    def _get_info(self, _, include_diff=False, known=None):
         repository_url = VCS_REPOSITORY_URL.get()
 
         if not repository_url:
@@ -1,5 +1,32 @@
 import os
-from subprocess import check_output
+from subprocess import check_output, call
+
+import six
+
+if six.PY3:
+    from functools import lru_cache
+    from shutil import which
+elif six.PY2:
+    # python 2 support
+    from backports.functools_lru_cache import lru_cache
+    from distutils.spawn import find_executable as which
+
+# opened once and shared by all commands (subprocess.DEVNULL opens /dev/null again for every Popen instance)
+_devnull = open(os.devnull, "wb")
+
+
+@lru_cache()
+def _resolve_executable(name):
+    """ Resolve an executable name to its full path (or return it as-is if it can't be found) """
+    return which(name) or name
+
+
+def _get_spawn_args(command):
+    """
+    Get the command with a full executable path, so that subprocess can launch it using posix_spawn instead of
+    fork + exec (used when there is no cwd, no preexec_fn and close_fds is False)
+    """
+    return [_resolve_executable(command[0])] + list(command[1:])
 
 
 def get_command_output(command, path=None):
@@ -8,5 +35,12 @@ def get_command_output(command, path=None):
     :raises CalledProcessError: when command execution fails
     :raises UnicodeDecodeError: when output decoding fails
     """
-    with open(os.devnull, "wb") as devnull:
-        return check_output(command, cwd=path, stderr=devnull).decode().strip()
+    return check_output(_get_spawn_args(command), cwd=path, stderr=_devnull, close_fds=False).decode().strip()
+
+
+def get_command_status(command, path=None):
+    """
+    Run a command and return its exit status, discarding its output
+    :raises OSError: when the command can't be executed
+    """
+    return call(_get_spawn_args(command), cwd=path, stdout=_devnull, stderr=_devnull, close_fds=False)
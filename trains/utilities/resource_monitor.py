@@ -1,120 +1,342 @@
-from time import time
-from threading import Thread, Event
+from importlib import import_module
+from threading import Thread, Event, Lock
 
+try:
+    from time import monotonic
+except ImportError:
+    # python 2 support
+    from time import time as monotonic
+
+import numpy as np
 import psutil
 from pathlib2 import Path
 from typing import Text
 
-try:
-    import gpustat
-except ImportError:
-    gpustat = None
-
 
 class ResourceMonitor(object):
     _title_machine = ':monitor:machine'
     _title_gpu = ':monitor:gpu'
+    _megabytes_per_byte = 1. / (1024 ** 2)
+    # disk usage and temperatures change slowly and are expensive to query on some platforms
+    _slow_stats_interval_sec = 5.
+    # gpu query modules, imported on first use (None if not installed)
+    _gpu_modules = {}
+    _gpu_key_names = ('temperature', 'utilization', 'mem_usage', 'mem_free_gb', 'mem_used_gb')
+    # repeated failures of the same kind are only reported once every this many occurrences
+    _error_report_interval = 100
+
+    # all running monitors in the process are driven by a single shared thread
+    _shared_lock = Lock()
+    _shared_wakeup = Event()
+    _shared_thread = None
+    _shared_monitors = []
+    # gpu stats are sampled once per process by a single shared gpu thread, and merged into every monitor's readouts
+    _gpu_wakeup = Event()
+    _gpu_thread = None
+    # None until gpu detection first runs, then whether gpu monitoring is available
+    _gpu_available = None
+    # latest gpu stats, replaced as a whole by the gpu thread (never modified in place)
+    _gpu_snapshot = {}
+    _pynvml = None
+    _nvml_handles = None
+    _gpustat = None
+    # per gpu readout keys, in _gpu_key_names order
+    _gpu_keys = []
 
-    def __init__(self, task, measure_frequency_times_per_sec=2., report_frequency_sec=30.):
+    def __init__(self, task, measure_frequency_times_per_sec=2., report_frequency_sec=30.,
+                 gpu_measure_frequency_times_per_sec=0.5):
         self._task = task
         self._measure_frequency = measure_frequency_times_per_sec
+        self._gpu_measure_frequency = gpu_measure_frequency_times_per_sec
         self._report_frequency = report_frequency_sec
+        self._measure_interval = 1.0 / measure_frequency_times_per_sec
+        self._last_report = None
+        self._next_report = None
+        self._next_measure = None
+        self._seconds_since_started = 0
         self._num_readouts = 0
-        self._readouts = {}
-        self._previous_readouts = {}
-        self._previous_readouts_ts = time()
-        self._thread = None
+        self._readouts_keys = []
+        self._readouts = np.zeros(0)
+        # number of samples summed into each readout (keys are not necessarily sampled on every tick)
+        self._readouts_counts = np.zeros(0)
+        self._cumulative_mask = np.zeros(0, dtype=bool)
+        self._previous_readouts = np.zeros(0)
+        self._previous_readouts_ts = monotonic()
+        self._gpu_warning_shown = False
         self._exit_event = Event()
-        if not gpustat:
-            self._task.get_logger().console('TRAINS Monitor: GPU monitoring is not available, '
-                                            'run \"pip install gpustat\"')
+        # failure counts, by (stage, exception type)
+        self._errors = {}
+        # constant for the lifetime of the process, no need to look these up on every readout
+        self._sensors_temperatures = getattr(psutil, 'sensors_temperatures', None)
+        self._home = Text(Path.home())
+        # cpu usage is computed from this monitor's own cpu times snapshots (psutil.cpu_percent() keeps a single
+        # process wide reference point, shared by every monitor)
+        self._cpu_times = self._get_cpu_busy_total_times()
+        self._slow_stats = {}
+        self._slow_stats_ts = None
 
     def start(self):
         self._exit_event.clear()
-        self._thread = Thread(target=self._daemon, daemon=True)
-        self._thread.start()
+        now = monotonic()
+        self._last_report = now
+        self._next_report = now + self._report_frequency
+        self._next_measure = now + self._measure_interval
+        cls = ResourceMonitor
+        with cls._shared_lock:
+            if self not in cls._shared_monitors:
+                cls._shared_monitors.append(self)
+            if not cls._shared_thread:
+                cls._shared_thread = Thread(target=cls._shared_daemon, daemon=True)
+                cls._shared_thread.start()
+            if not cls._gpu_thread and cls._gpu_available is not False:
+                cls._gpu_available = cls._init_gpu()
+                if cls._gpu_available:
+                    cls._gpu_thread = Thread(target=cls._gpu_daemon, daemon=True)
+                    cls._gpu_thread.start()
+            gpu_available = cls._gpu_available
+        cls._shared_wakeup.set()
+        cls._gpu_wakeup.set()
+        if not gpu_available and not self._gpu_warning_shown:
+            self._gpu_warning_shown = True
+            self._task.get_logger().console('TRAINS Monitor: GPU monitoring is not available, '
+                                            'run \"pip install gpustat\"')
 
     def stop(self):
         self._exit_event.set()
-        # self._thread.join()
+        cls = ResourceMonitor
+        with cls._shared_lock:
+            if self in cls._shared_monitors:
+                cls._shared_monitors.remove(self)
+        cls._shared_wakeup.set()
+        cls._gpu_wakeup.set()
 
-    def _daemon(self):
-        logger = self._task.get_logger()
-        seconds_since_started = 0
+    @classmethod
+    def _shared_daemon(cls):
         while True:
-            last_report = time()
-            while (time() - last_report) < self._report_frequency:
-                # wait for self._measure_frequency seconds, if event set quit
-                if self._exit_event.wait(1.0 / self._measure_frequency):
+            with cls._shared_lock:
+                monitors = list(cls._shared_monitors)
+                if not monitors:
+                    # last monitor was stopped, the next start() will launch a new thread
+                    cls._shared_thread = None
                     return
-                # noinspection PyBroadException
-                try:
-                    self._update_readouts()
-                except Exception:
-                    pass
+                cls._shared_wakeup.clear()
 
-            average_readouts = self._get_average_readouts()
-            seconds_since_started += int(round(time() - last_report))
-            for k, v in average_readouts.items():
+            next_due = None
+            for monitor in monitors:
+                now = monotonic()
                 # noinspection PyBroadException
                 try:
-                    title = self._title_gpu if k.startswith('gpu_') else self._title_machine
-                    # 3 points after the dot
-                    value = round(v*1000) / 1000.
-                    logger.report_scalar(title=title, series=k, iteration=seconds_since_started, value=value)
-                except Exception:
-                    pass
-            self._clear_readouts()
+                    due = monitor._step(now)
+                except Exception as ex:
+                    monitor._report_error('monitor', ex)
+                    due = now + monitor._measure_interval
+                next_due = due if next_due is None else min(next_due, due)
+
+            # wait until the next monitor is due, or until monitors are started / stopped
+            cls._shared_wakeup.wait(max(0., next_due - monotonic()))
+
+    def _step(self, now):
+        """
+        Take a measurement and send a report, if these are due
+        :param now: Current monotonic time
+        :return: Monotonic time at which this monitor is next due
+        """
+        if self._exit_event.is_set():
+            return now + self._measure_interval
+
+        if now >= self._next_measure:
+            self._next_measure += self._measure_interval
+            if self._next_measure <= now:
+                # running late, skip the missed measurements instead of sampling again right away
+                self._next_measure = now + self._measure_interval
+            # noinspection PyBroadException
+            try:
+                self._update_readouts()
+            except Exception as ex:
+                self._report_error('readout', ex)
+
+        if now >= self._next_report:
+            self._seconds_since_started += int(round(now - self._last_report))
+            self._last_report = now
+            self._next_report = now + self._report_frequency
+            self._report_readouts()
+
+        return min(self._next_measure, self._next_report)
+
+    def _report_readouts(self):
+        report_scalar = self._task.get_logger().report_scalar
+        for k, v in self._get_average_readouts().items():
+            title = self._title_gpu if k.startswith('gpu_') else self._title_machine
+            # noinspection PyBroadException
+            try:
+                report_scalar(title=title, series=k, iteration=self._seconds_since_started, value=v)
+            except Exception as ex:
+                self._report_error('report', ex)
+        self._clear_readouts()
+
+    @classmethod
+    def _gpu_daemon(cls):
+        while True:
+            with cls._shared_lock:
+                monitors = list(cls._shared_monitors)
+                if not monitors:
+                    # last monitor was stopped, this thread is the only NVML user, release it before leaving
+                    cls._gpu_snapshot = {}
+                    cls._shutdown_nvml()
+                    cls._gpu_thread = None
+                    return
+                cls._gpu_wakeup.clear()
+
+            # noinspection PyBroadException
+            try:
+                cls._gpu_snapshot = cls._gpu_stats()
+            except Exception as ex:
+                # do not keep reporting the last good values for a failing gpu
+                cls._gpu_snapshot = {}
+                for monitor in monitors:
+                    monitor._report_error('gpu readout', ex)
+
+            # gpu queries are expensive, sample them at a lower frequency than the machine stats
+            # (as often as the most demanding running monitor asks for)
+            cls._gpu_wakeup.wait(min(1.0 / monitor._gpu_measure_frequency for monitor in monitors))
+
+    def _report_error(self, stage, ex):
+        """
+        Count a monitoring failure, and warn on the first occurrence and then once every _error_report_interval
+        occurrences of the same kind (failures never stop the monitor)
+        """
+        key = (stage, type(ex).__name__)
+        count = self._errors.get(key, 0) + 1
+        self._errors[key] = count
+        if (count - 1) % self._error_report_interval:
+            return
+        # noinspection PyBroadException
+        try:
+            self._task.get_logger().console('TRAINS Monitor: {} failed ({} times): {}: {}'.format(
+                stage, count, type(ex).__name__, ex))
+        except Exception:
+            pass
+
+    @classmethod
+    def _get_gpu_module(cls, name):
+        """
+        Import a gpu query module once, on first use
+        :return: The module, or None if it is not installed
+        """
+        if name not in cls._gpu_modules:
+            try:
+                cls._gpu_modules[name] = import_module(name)
+            except ImportError:
+                cls._gpu_modules[name] = None
+        return cls._gpu_modules[name]
+
+    @classmethod
+    def _init_gpu(cls):
+        """
+        Detect how gpu stats can be queried, preferring NVML and falling back to gpustat
+        :return: True if gpu monitoring is available
+        """
+        cls._nvml_handles = cls._init_nvml()
+        if cls._nvml_handles is None:
+            cls._gpustat = cls._get_gpu_module('gpustat')
+        return cls._nvml_handles is not None or bool(cls._gpustat)
+
+    @classmethod
+    def _init_nvml(cls):
+        """
+        :return: list of NVML device handles, or None if NVML is not available
+        """
+        pynvml = cls._pynvml = cls._get_gpu_module('pynvml')
+        if not pynvml:
+            return None
+        # noinspection PyBroadException
+        try:
+            pynvml.nvmlInit()
+        except Exception:
+            return None
+        # noinspection PyBroadException
+        try:
+            return [pynvml.nvmlDeviceGetHandleByIndex(i) for i in range(pynvml.nvmlDeviceGetCount())]
+        except Exception:
+            pynvml.nvmlShutdown()
+            return None
+
+    @classmethod
+    def _shutdown_nvml(cls):
+        if cls._nvml_handles is None:
+            return
+        cls._nvml_handles = None
+        # noinspection PyBroadException
+        try:
+            cls._pynvml.nvmlShutdown()
+        except Exception:
+            pass
 
     def _update_readouts(self):
         readouts = self._machine_stats()
-        elapsed = time() - self._previous_readouts_ts
-        self._previous_readouts_ts = time()
-        for k, v in readouts.items():
+        now = monotonic()
+        elapsed = now - self._previous_readouts_ts
+        if elapsed <= 0:
+            # coarse clock, no time passed since the previous readout and rates can't be computed, skip it
+            return
+        self._previous_readouts_ts = now
+        new_keys = set(readouts).difference(self._readouts_keys)
+        if new_keys:
+            new_keys = sorted(new_keys)
+            self._readouts_keys.extend(new_keys)
+            self._readouts = np.append(self._readouts, np.zeros(len(new_keys)))
+            self._readouts_counts = np.append(self._readouts_counts, np.zeros(len(new_keys)))
+            self._previous_readouts = np.append(self._previous_readouts, np.full(len(new_keys), np.nan))
             # cumulative measurements
-            if k.endswith('_mbs'):
-                v = (v - self._previous_readouts.get(k, v)) / elapsed
+            self._cumulative_mask = np.array([k.endswith('_mbs') for k in self._readouts_keys], dtype=bool)
 
-            self._readouts[k] = self._readouts.get(k, 0.0) + v
+        # keys missing from this readout are nan, and are neither summed nor counted
+        values = np.fromiter(
+            (readouts.get(k, np.nan) for k in self._readouts_keys), dtype=np.float64, count=len(self._readouts_keys))
+        # cumulative measurements are only valid if the previous readout had the same key
+        valid = ~np.isnan(values) & ~(self._cumulative_mask & np.isnan(self._previous_readouts))
+        rates = np.where(self._cumulative_mask, (values - self._previous_readouts) / elapsed, values)
+        self._readouts += np.where(valid, rates, 0.)
+        self._readouts_counts += valid
         self._num_readouts += 1
-        self._previous_readouts = readouts
+        self._previous_readouts = values
 
     def _get_num_readouts(self):
         return self._num_readouts
 
     def _get_average_readouts(self):
-        average_readouts = dict((k, v/float(self._num_readouts)) for k, v in self._readouts.items())
+        sampled = np.flatnonzero(self._readouts_counts)
+        # 3 points after the dot, rounded in a single vectorized operation
+        averages = np.round(self._readouts[sampled] / self._readouts_counts[sampled], 3).tolist()
+        average_readouts = dict(zip((self._readouts_keys[i] for i in sampled), averages))
         return average_readouts
 
     def _clear_readouts(self):
-        self._readouts = {}
+        self._readouts = np.zeros(len(self._readouts_keys))
+        self._readouts_counts = np.zeros(len(self._readouts_keys))
         self._num_readouts = 0
 
-    @staticmethod
-    def _machine_stats():
+    def _machine_stats(self):
         """
         :return: machine stats dictionary, all values expressed in megabytes
         """
-        cpu_usage = [float(v) for v in psutil.cpu_percent(percpu=True)]
-        stats = {
-            "cpu_usage": sum(cpu_usage) / float(len(cpu_usage)),
-        }
+        stats = {}
+        # system wide average, same as averaging per cpu readouts, but only reads the aggregated cpu times
+        busy, total = self._get_cpu_busy_total_times()
+        previous_busy, previous_total = self._cpu_times
+        self._cpu_times = busy, total
+        if total > previous_total:
+            stats["cpu_usage"] = min(100., max(0., 100. * (busy - previous_busy) / (total - previous_total)))
 
-        bytes_per_megabyte = 1024 ** 2
+        megabytes_per_byte = self._megabytes_per_byte
 
         def bytes_to_megabytes(x):
-            return x / bytes_per_megabyte
+            return x * megabytes_per_byte
 
         virtual_memory = psutil.virtual_memory()
         stats["memory_used_gb"] = bytes_to_megabytes(virtual_memory.used) / 1024
         stats["memory_free_gb"] = bytes_to_megabytes(virtual_memory.available) / 1024
-        disk_use_percentage = psutil.disk_usage(Text(Path.home())).percent
-        stats["disk_free_percent"] = 100.0-disk_use_percentage
-        sensor_stat = (
-            psutil.sensors_temperatures() if hasattr(psutil, "sensors_temperatures") else {}
-        )
-        if "coretemp" in sensor_stat and len(sensor_stat["coretemp"]):
-            stats["cpu_temperature"] = max([float(t.current) for t in sensor_stat["coretemp"]])
+        stats.update(self._get_slow_stats())
 
         # update cached measurements
         net_stats = psutil.net_io_counters()
@@ -124,15 +346,89 @@ class ResourceMonitor(object):
         stats["io_read_mbs"] = bytes_to_megabytes(io_stats.read_bytes)
         stats["io_write_mbs"] = bytes_to_megabytes(io_stats.write_bytes)
 
-        # check if we can access the gpu statistics
-        if gpustat:
-            gpu_stat = gpustat.new_query()
-            for i, g in enumerate(gpu_stat.gpus):
-                stats["gpu_%d_temperature" % i] = float(g["temperature.gpu"])
-                stats["gpu_%d_utilization" % i] = float(g["utilization.gpu"])
-                stats["gpu_%d_mem_usage" % i] = 100. * float(g["memory.used"]) / float(g["memory.total"])
+        # latest gpu statistics (if available), sampled by the gpu thread
+        stats.update(self._gpu_snapshot)
+
+        return stats
+
+    @staticmethod
+    def _get_cpu_busy_total_times():
+        """
+        :return: (busy, total) system wide cpu times, computed the same way psutil.cpu_percent() does
+        """
+        times = psutil.cpu_times()
+        # guest times are already included in user / nice times (linux)
+        total = sum(times) - getattr(times, 'guest', 0.) - getattr(times, 'guest_nice', 0.)
+        busy = total - times.idle - getattr(times, 'iowait', 0.)
+        return busy, total
+
+    def _get_slow_stats(self):
+        """
+        :return: disk and temperature stats dictionary, refreshed at most every _slow_stats_interval_sec seconds
+        """
+        now = monotonic()
+        if self._slow_stats_ts is not None and now - self._slow_stats_ts < self._slow_stats_interval_sec:
+            return self._slow_stats
+
+        stats = {}
+        disk_use_percentage = psutil.disk_usage(self._home).percent
+        stats["disk_free_percent"] = 100.0-disk_use_percentage
+        sensor_stat = self._sensors_temperatures() if self._sensors_temperatures else {}
+        core_temperatures = sensor_stat.get("coretemp")
+        if core_temperatures:
+            stats["cpu_temperature"] = max([float(t.current) for t in core_temperatures])
+
+        self._slow_stats = stats
+        self._slow_stats_ts = now
+        return stats
+
+    @classmethod
+    def _get_gpu_keys(cls, count):
+        """
+        :return: list of readout key tuples (in _gpu_key_names order) for at least count gpus, built only once
+        """
+        for i in range(len(cls._gpu_keys), count):
+            cls._gpu_keys.append(tuple("gpu_%d_%s" % (i, name) for name in cls._gpu_key_names))
+        return cls._gpu_keys
+
+    @classmethod
+    def _gpu_stats(cls):
+        """
+        :return: gpu stats dictionary, memory values expressed in gigabytes
+        """
+        stats = {}
+        handles = cls._nvml_handles
+        if handles is not None:
+            pynvml = cls._pynvml
+            bytes_per_gigabyte = float(1024 ** 3)
+            for handle, keys in zip(handles, cls._get_gpu_keys(len(handles))):
+                temperature, utilization, mem_usage, mem_free_gb, mem_used_gb = keys
+                # some boards do not support every query (NVML_ERROR_NOT_SUPPORTED), skip only what fails
+                try:
+                    stats[temperature] = float(
+                        pynvml.nvmlDeviceGetTemperature(handle, pynvml.NVML_TEMPERATURE_GPU))
+                except pynvml.NVMLError:
+                    pass
+                try:
+                    stats[utilization] = float(pynvml.nvmlDeviceGetUtilizationRates(handle).gpu)
+                except pynvml.NVMLError:
+                    pass
+                try:
+                    memory = pynvml.nvmlDeviceGetMemoryInfo(handle)
+                except pynvml.NVMLError:
+                    continue
+                stats[mem_usage] = 100. * float(memory.used) / float(memory.total)
+                stats[mem_free_gb] = float(memory.total - memory.used) / bytes_per_gigabyte
+                stats[mem_used_gb] = float(memory.used) / bytes_per_gigabyte
+        elif cls._gpustat:
+            gpus = cls._gpustat.new_query().gpus
+            for g, keys in zip(gpus, cls._get_gpu_keys(len(gpus))):
+                temperature, utilization, mem_usage, mem_free_gb, mem_used_gb = keys
+                stats[temperature] = float(g["temperature.gpu"])
+                stats[utilization] = float(g["utilization.gpu"])
+                stats[mem_usage] = 100. * float(g["memory.used"]) / float(g["memory.total"])
                 # already in MBs
-                stats["gpu_%d_mem_free_gb" % i] = float(g["memory.total"] - g["memory.used"]) / 1024
-                stats["gpu_%d_mem_used_gb" % i] = float(g["memory.used"]) / 1024
+                stats[mem_free_gb] = float(g["memory.total"] - g["memory.used"]) / 1024
+                stats[mem_used_gb] = float(g["memory.used"]) / 1024
 
         return stats